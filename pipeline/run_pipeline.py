@@ -5,13 +5,18 @@
 # Import required libraries
 import os                          # For reading environment variables
 import pandas as pd               # For data processing (DataFrames)
-from sqlalchemy import create_engine, text  # For DB connection + SQL execution
-from datetime import datetime     # For timestamps
+import connectorx as cx                     # For parallel columnar DB reads
+import pyarrow as pa                        # For Arrow-native DB writes
+from adbc_driver_postgresql.dbapi import connect as adbc_connect  # Arrow → Postgres COPY
+import time                        # For measuring pipeline duration
 
 # Initial logs
 print("🚀 ML PIPELINE STARTED")
 print("-" * 60)
 
+# Monotonic clock for duration (wall clocks can jump)
+start_time = time.perf_counter()
+
 # =========================
 # ENV CONFIG
 # =========================
@@ -33,53 +38,21 @@ print("✅ Environment variables loaded")
 # =========================
 # DB CONNECTIONS
 # =========================
-# Create database engines (connections)
-# events_engine → reads from user_events table
-# reco_engine   → writes into recommendations table
-events_engine = create_engine(EVENTS_DB_URL)
-reco_engine = create_engine(RECO_DB_URL)
+# events reads go through ConnectorX (multi-threaded columnar fetch)
+# reco writes go through ADBC (Arrow-native COPY)
+# Both speak plain libpq URIs → strip the "+psycopg2" driver suffix
+EVENTS_CX_URI = EVENTS_DB_URL.replace("+psycopg2", "", 1)
+RECO_ADBC_URI = RECO_DB_URL.replace("+psycopg2", "", 1)
 
-print("✅ DB connections ready")
+print("✅ DB connections configured (connect on first use)")
 print("-" * 60)
 
 # =========================
-# STEP 1: FETCH EVENTS
-# =========================
-# Fetch only relevant events from DB
-# - user_id must exist
-# - only product-related events (important for ML)
-events_df = pd.read_sql("""
-    SELECT user_id, event_type, object_id
-    FROM user_events
-    WHERE user_id IS NOT NULL
-      AND object_type = 'product'
-""", events_engine)
-
-print(f"📊 Events fetched: {len(events_df)}")
-
-# If no events, stop pipeline safely
-if events_df.empty:
-    print("⚠️ No events found. Exiting safely.")
-    exit(0)
-
-# =========================
-# STEP 2: CLEAN DATA
-# =========================
-# Convert object_id → numeric
-# (sometimes DB stores as string, so we fix it)
-events_df["object_id"] = pd.to_numeric(events_df["object_id"], errors="coerce")
-
-# Drop rows where conversion failed (invalid product_id)
-events_df = events_df.dropna(subset=["object_id"])
-
-# Convert to integer (final clean product_id)
-events_df["object_id"] = events_df["object_id"].astype(int)
-
-# =========================
-# STEP 3: EVENT WEIGHTS
+# EVENT WEIGHTS
 # =========================
 # Assign importance (weights) to each event type
 # Higher weight = more importance in recommendation
+# Single source of truth — rendered into the SQL below
 EVENT_WEIGHTS = {
     "view_product": 1,        # low signal
     "add_to_cart": 3,         # medium signal
@@ -87,64 +60,116 @@ EVENT_WEIGHTS = {
     "order_cancelled": -3     # negative signal
 }
 
-# Map event_type → score
-events_df["score"] = events_df["event_type"].map(EVENT_WEIGHTS).fillna(0)
-
-# Remove events with score = 0 (not useful)
-events_df = events_df[events_df["score"] != 0]
-
-print(f"🎯 Useful events after filtering: {len(events_df)}")
-
-# If no useful events, stop
-if events_df.empty:
-    print("⚠️ No useful events after scoring. Exiting safely.")
-    exit(0)
+# Render the dict as SQL VALUES rows, e.g. ('view_product', 1), ...
+# (keys are trusted module constants, safe to inline)
+WEIGHT_VALUES = ", ".join(
+    f"('{event_type}', {weight})"
+    for event_type, weight in EVENT_WEIGHTS.items()
+)
 
 # =========================
-# STEP 4: FEATURE BUILDING
-# =========================
-# Group by user + product
-# Sum scores → total interest per product per user
-features_df = (
-    events_df
-    .groupby(["user_id", "object_id"])["score"]
-    .sum()
-    .reset_index()
-    .rename(columns={"object_id": "product_id"})
+# STEP 1: FETCH RANKED FEATURES (SQL)
+# =========================
+# Cleaning, scoring, feature building and ranking all happen
+# inside Postgres in ONE query:
+# - event weights via an inner join to a tiny VALUES table
+#   (unknown event types simply don't join → dropped for free)
+# - invalid product ids filtered with a regex (object_id must be digits)
+# - SUM + GROUP BY → total interest per (user, product)
+# - ROW_NUMBER per user → rank, keep only top K
+# Only ~K rows per user travel over the network
+# instead of every raw event row
+RANKED_EVENTS_SQL = """
+    WITH scored AS (
+        SELECT
+            e.user_id,
+            e.object_id::int AS product_id,
+            SUM(w.score) AS score
+        FROM user_events e
+        JOIN (VALUES {weights}) AS w(event_type, score)
+          ON e.event_type = w.event_type
+        WHERE e.user_id IS NOT NULL
+          AND e.object_type = 'product'
+          AND e.object_id ~ '^[0-9]+$'
+        GROUP BY e.user_id, e.object_id
+    ),
+    ranked AS (
+        SELECT
+            *,
+            ROW_NUMBER() OVER (
+                PARTITION BY user_id
+                ORDER BY score DESC
+            ) AS rank
+        FROM scored
+    )
+    SELECT user_id, product_id, score, rank
+    FROM ranked
+    WHERE rank <= {k}
+"""
+
+# ConnectorX plans the user_id partitions with a MIN/MAX range query,
+# which panics (instead of returning an empty frame) when NO rows
+# qualify — so check for qualifying events first with a cheap EXISTS
+# (stops at the first matching row)
+# NOTE: keep the JOIN/WHERE in sync with RANKED_EVENTS_SQL above
+HAS_EVENTS_SQL = """
+    SELECT EXISTS (
+        SELECT 1
+        FROM user_events e
+        JOIN (VALUES {weights}) AS w(event_type, score)
+          ON e.event_type = w.event_type
+        WHERE e.user_id IS NOT NULL
+          AND e.object_type = 'product'
+          AND e.object_id ~ '^[0-9]+$'
+    ) AS has_events
+"""
+
+has_events_df = cx.read_sql(
+    EVENTS_CX_URI,
+    HAS_EVENTS_SQL.format(weights=WEIGHT_VALUES),
+    return_type="pandas"
 )
 
-print(f"🧠 Feature rows: {len(features_df)}")
+# If no qualifying events, stop pipeline safely
+if not bool(has_events_df["has_events"].iloc[0]):
+    print("⚠️ No events found. Exiting safely.")
+    exit(0)
 
-# =========================
-# STEP 5: RANKING
-# =========================
-# Rank products per user based on score
-# Highest score → rank 1
-features_df["rank"] = (
-    features_df
-    .groupby("user_id")["score"]
-    .rank(method="first", ascending=False)
+# ConnectorX splits the query into 8 ranges of user_id and fetches
+# them on parallel connections, straight into columnar buffers
+# (no per-row Python objects, fetch overlaps across partitions)
+ranked_df = cx.read_sql(
+    EVENTS_CX_URI,
+    RANKED_EVENTS_SQL.format(weights=WEIGHT_VALUES, k=TOP_K),
+    partition_on="user_id",
+    partition_num=8,
+    return_type="pandas"
 )
 
-# Keep only top K recommendations per user
-ranked_df = features_df[features_df["rank"] <= TOP_K]
-
-print(f"📊 Ranked rows: {len(ranked_df)}")
+print(f"📊 Ranked rows fetched: {len(ranked_df)}")
 
-# If no ranked data, stop
+# If no ranked data, stop pipeline safely
 if ranked_df.empty:
     print("⚠️ No ranked data. Exiting safely.")
     exit(0)
 
+# Downcast columns (Postgres bigints arrive as int64)
+# Smaller dtypes → half the memory traffic in every step below
+ranked_df["user_id"] = pd.to_numeric(ranked_df["user_id"], downcast="unsigned")
+ranked_df["product_id"] = ranked_df["product_id"].astype("int32")
+ranked_df["score"] = pd.to_numeric(ranked_df["score"], downcast="integer")
+ranked_df["rank"] = ranked_df["rank"].astype("int16")   # rank <= TOP_K
+
 # =========================
-# STEP 6: FINAL DATA
+# STEP 2: FINAL DATA
 # =========================
 # Copy final dataset
 final_df = ranked_df.copy()
 
 # Generate ONE timestamp for this pipeline run
 # (important: all rows get same consistent time)
-current_time = datetime.utcnow()
+# pd.Timestamp → stored as a datetime64[ns] scalar, not N Python objects
+current_time = pd.Timestamp.now("UTC").tz_localize(None)
 
 # created_at → when record FIRST inserted
 # updated_at → when record LAST updated
@@ -159,41 +184,52 @@ final_df = final_df[
 print(f"🔥 FINAL ROWS: {len(final_df)}")
 
 # =========================
-# STEP 7: UPSERT INTO DB
+# STEP 3: UPSERT INTO DB
 # =========================
 # UPSERT = INSERT + UPDATE
 # If row exists → update
 # If not → insert
+UPSERT_FROM_STAGE_SQL = """
+    INSERT INTO recommendations
+    (user_id, product_id, score, rank, created_at, updated_at)
+
+    SELECT user_id, product_id, score, rank, created_at, updated_at
+    FROM reco_stage
+
+    ON CONFLICT (user_id, product_id)
+    DO UPDATE SET
+        score = EXCLUDED.score,
+        rank = EXCLUDED.rank,
+        updated_at = EXCLUDED.updated_at
+
+    -- IMPORTANT:
+    -- created_at is NOT updated
+    -- so original creation time is preserved
+"""
+
 try:
-    with reco_engine.begin() as conn:
-
-        # Loop through each row
-        for _, row in final_df.iterrows():
-
-            conn.execute(text("""
-                INSERT INTO recommendations
-                (user_id, product_id, score, rank, created_at, updated_at)
-
-                VALUES
-                (:user_id, :product_id, :score, :rank, :created_at, :updated_at)
-
-                ON CONFLICT (user_id, product_id)
-                DO UPDATE SET
-                    score = EXCLUDED.score,
-                    rank = EXCLUDED.rank,
-                    updated_at = EXCLUDED.updated_at;
-
-                -- IMPORTANT:
-                -- created_at is NOT updated
-                -- so original creation time is preserved
-            """), {
-                "user_id": int(row["user_id"]),          # convert to int
-                "product_id": int(row["product_id"]),    # convert to int
-                "score": float(row["score"]),            # convert to float
-                "rank": int(row["rank"]),                # convert to int
-                "created_at": row["created_at"],         # timestamp
-                "updated_at": row["updated_at"]          # timestamp
-            })
+    # Convert ONCE to Arrow (columnar, zero per-cell Python objects)
+    arrow_table = pa.Table.from_pandas(final_df, preserve_index=False)
+
+    with adbc_connect(RECO_ADBC_URI) as conn:
+        with conn.cursor() as cur:
+
+            # Ingest into a TEMP staging table via Postgres binary COPY
+            # (Arrow batches map straight onto the COPY format)
+            cur.adbc_ingest(
+                "reco_stage",
+                arrow_table,
+                mode="create",
+                temporary=True
+            )
+
+            # ONE server-side statement merges the stage into the
+            # real table, keeping the upsert semantics
+            cur.execute(UPSERT_FROM_STAGE_SQL)
+
+        # Single commit → stage + merge are atomic,
+        # and the temp table vanishes with the connection
+        conn.commit()
 
     print("✅ RECOMMENDATIONS UPSERTED SUCCESSFULLY")
 
@@ -204,4 +240,5 @@ except Exception as e:
 
 # Final success log
 print("-" * 60)
+print(f"⏱️ Duration: {time.perf_counter() - start_time:.2f}s")
 print("🎉 PIPELINE COMPLETED SUCCESSFULLY")